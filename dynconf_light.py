@@ -15,15 +15,28 @@
 # THE SOFTWARE.
 #
 from __future__ import print_function
-import sys, os
-from jinja2 import Environment, BaseLoader
+import sys, os, re, logging
+from jinja2 import Environment, FunctionLoader, FileSystemBytecodeCache
 from netmiko import ConnectHandler, ssh_exception
 import paramiko
-import threading, copy, datetime, math
-import csv, json
+import threading, time, atexit, weakref, queue, select, traceback
+from collections import defaultdict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+import multiprocessing
+import csv, json, io, tarfile
+from pathlib import Path
+try:
+	import orjson
+except ImportError:
+	orjson = None
+try:
+	import msvcrt
+except ImportError:
+	msvcrt = None
 from optparse import OptionParser
 
-VERSION = '1.6.10'
+VERSION = '1.6.11'
 """
 VERISON NOTES:
 	1.5.1: Stable, dumps to super log, does not save json data. No plugin operation. No object orientation. Utilizes multiprocessing.
@@ -38,6 +51,7 @@ VERISON NOTES:
 	1.6.8: Monkey patch for super-logging and command except failures
 	1.6.9: KeyboardInterrupt Handling, SEND_FAILED retries, Retry Logging Append
 	1.6.10: Fist Fuck the device over SSH if he doesn't like my commands
+	1.6.11: Render Mode sessions render device input lazily, streaming to disk in render(); template errors surface on first use rather than at load.
 """
 
 def patch_crypto_be_discovery():
@@ -62,278 +76,627 @@ def patch_crypto_be_discovery():
 	backends._available_backends_list = [
 		be for be in (be_cc, be_ossl) if be is not None
 	]
-patch_crypto_be_discovery()
+if getattr(sys, 'frozen', False) or os.environ.get('DYNCONF_FORCE_CRYPTO_PATCH'):
+	patch_crypto_be_discovery()
+
+#Paramiko failures are already recorded in each device log; keep its tracebacks off stderr
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+PYARROW_CSV_THRESHOLD = 1 << 20
+
+def read_csv_rows(filename):
+
+	"""
+	Yields each row of a CSV inventory as a dict of strings.
+	Objective: hand large inventories to pyarrow's native reader when it is installed, yielding the same rows as csv.reader.
+	"""
+
+	pacsv = None
+	if os.path.getsize(filename) >= PYARROW_CSV_THRESHOLD:
+		try:
+			import pyarrow
+			from pyarrow import csv as pacsv
+		except ImportError:
+			pass
+	with open(filename, 'r', buffering=1 << 20, newline='', encoding='utf-8-sig') as f:
+		reader = csv.reader(f)
+		header = next(reader, [])
+		if pacsv is not None:
+			#Parse fully before yielding so a ragged inventory can still fall back to csv.reader
+			convert_options = pacsv.ConvertOptions(column_types={name: pyarrow.string() for name in header}, strings_can_be_null=False)
+			try:
+				table = pacsv.read_csv(filename, convert_options=convert_options)
+			except pyarrow.ArrowInvalid:
+				table = None
+			if table is not None:
+				for batch in table.to_batches():
+					for row in batch.to_pylist():
+						yield row
+				return
+		for row in reader:
+			if row:
+				yield dict(zip(header, row))
+
+def read_json_rows(filename):
+
+	"""
+	Yields each device object from a JSON inventory holding a list of objects.
+	Objective: accept the JSON data files offered by the command line prompt.
+	"""
+
+	with open(filename, 'rb') as f:
+		data = orjson.loads(f.read()) if orjson else json.load(f)
+	for row in data:
+		yield row
+
+DATA_READERS = {'.csv': read_csv_rows, '.json': read_json_rows}
+
+TEMPLATE_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.dynconf_jinja_cache')
+
+def load_template_source(filename):
+
+	"""
+	Reads a template file for the Jinja loader.
+	Objective: address templates by filename so their compiled bytecode can be cached.
+	"""
+
+	with open(filename, 'r') as f:
+		return f.read(), os.path.abspath(filename), None
+
+def build_template_environment(cache_directory=TEMPLATE_CACHE_DIRECTORY):
+
+	"""
+	Builds a Jinja environment backed by an on-disk bytecode cache.
+	Objective: skip template compilation on repeated runs over the same templates.
+	"""
+
+	try:
+		if not os.path.exists(cache_directory):
+			os.makedirs(cache_directory)
+		bytecode_cache = FileSystemBytecodeCache(directory=cache_directory)
+	except OSError:
+		bytecode_cache = None
+	return Environment(loader=FunctionLoader(load_template_source), bytecode_cache=bytecode_cache, autoescape=False, auto_reload=False, optimized=True, cache_size=400)
+
+TEMPLATE_ENVIRONMENT = build_template_environment()
+
+SUMMARY_ROW = '{:<16}{:<16}{:<16}{:<16}\n'
+
+def init_render_worker(template):
+
+	"""
+	Prepares a render worker process with the session template.
+	Objective: compile each template once per worker rather than once per device.
+	"""
+
+	global RENDER_TEMPLATE
+	RENDER_TEMPLATE = TEMPLATE_ENVIRONMENT.from_string(template) if template is not None else None
+
+def render_template(job):
+
+	"""
+	Renders one device input inside a render worker process.
+	Objective: spread template rendering across cores for large inventories.
+	"""
+
+	template_filename, context = job
+	if template_filename:
+		return TEMPLATE_ENVIRONMENT.get_template(template_filename).render(context)
+	return RENDER_TEMPLATE.render(context)
+
+@lru_cache(maxsize=4096)
+def line_break(line_char, info):
+
+	"""
+	Centers an upper-cased heading within a rule of line_char for device logs.
+	Objective: keep the historical 87/88 column rule widths with a single str.center call,
+	memoised since status and command headings repeat across devices.
+	"""
+
+	return '\n{0}\n'.format(' {0} '.format(info.upper()).center(88 - len(info) % 2, line_char))
+
+def console_ready(timeout):
+
+	"""
+	Waits up to timeout seconds for console input to become readable.
+	Objective: let a listener thread check for shutdown instead of parking in input().
+	"""
+
+	if msvcrt:
+		#Windows can not select on stdin, so poll the console keyboard instead
+		deadline = time.time() + timeout
+		while not msvcrt.kbhit():
+			if time.time() >= deadline:
+				return False
+			time.sleep(0.05)
+		return True
+	return bool(select.select([sys.stdin], [], [], timeout)[0])
+
+class ConnectionPool:
+	def __init__(self, idleTimeout=300, maxAge=3600):
+		self.idleTimeout = idleTimeout
+		self.maxAge = maxAge
+		self.connections = defaultdict(deque)
+		self.created = weakref.WeakKeyDictionary()
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def key(connectionData):
+		return (connectionData['host'], connectionData['port'], connectionData['username'], connectionData['device_type'])
+
+	def acquire(self, connectionData):
+		key = self.key(connectionData)
+		while True:
+			with self.lock:
+				expired = self.__expire()
+				idle = self.connections[key]
+				connection = idle.pop()[0] if idle else None
+			for stale in expired:
+				stale.disconnect()
+			if connection is None:
+				connection = ConnectHandler(**connectionData)
+				with self.lock:
+					self.created[connection] = time.time()
+				return connection
+			#Health check before handing a pooled connection back out
+			if connection.is_alive():
+				return connection
+			connection.disconnect()
+
+	def release(self, connectionData, connection):
+		with self.lock:
+			#Retire sessions past their maximum age rather than pooling them again
+			retire = time.time() - self.created.get(connection, 0) >= self.maxAge
+			if not retire:
+				self.connections[self.key(connectionData)].append((connection, time.time()))
+		if retire:
+			connection.disconnect()
+
+	def discard(self, connectionData):
+		with self.lock:
+			idle = self.connections.pop(self.key(connectionData), ())
+		for connection, released in idle:
+			connection.disconnect()
+
+	def close(self):
+		with self.lock:
+			idle = [connection for connections in self.connections.values() for connection, released in connections]
+			self.connections.clear()
+		for connection in idle:
+			connection.disconnect()
+
+	def __expire(self):
+		expired = []
+		cutoff = time.time() - self.idleTimeout
+		for connections in self.connections.values():
+			while connections and connections[0][1] < cutoff:
+				expired.append(connections.popleft()[0])
+		return expired
+
+CONNECTION_POOL = ConnectionPool()
+atexit.register(CONNECTION_POOL.close)
+
+class ConsoleWriter:
+	def __init__(self, stream=None):
+		self.stream = stream
+		self.queue = queue.Queue()
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def write(self, message):
+		#Start the writer lazily so render worker processes importing the module never spawn it
+		if self.thread is None:
+			with self.lock:
+				if self.thread is None:
+					self.thread = threading.Thread(target=self.__drain, name='dynconf-console', daemon=True)
+					self.thread.start()
+		self.queue.put(message + '\n')
+
+	def close(self):
+		with self.lock:
+			thread, self.thread = self.thread, None
+		if thread is not None:
+			self.queue.put(None)
+			thread.join()
+
+	def __drain(self):
+		while True:
+			batch = [self.queue.get()]
+			try:
+				while True:
+					batch.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			stream = self.stream or sys.stdout
+			stream.write(''.join(message for message in batch if message is not None))
+			stream.flush()
+			if None in batch:
+				return
+
+CONSOLE = ConsoleWriter()
+atexit.register(CONSOLE.close)
 
 class Session:
+	__slots__ = ('id', 'directory', 'compact', 'mode', 'devices', 'executor', 'maxThreads', 'stopped', 'archive')
 	datum_schema = ["host","device_type"]
-	maxThreads = 3
-	def __init__(self, data, template, default_username='admin', default_password='Password1', default_secret='Secret1', directory=None, mode='RENDER', **kwargs):
-		self.id = 'session'
-		if 'id' in kwargs.keys():
-			self.id = kwargs['id']
+	processRenderThreshold = 500
+	internedColumns = ('device_type', 'username')
+	def __init__(self, data, template, default_username='admin', default_password='Password1', default_secret='Secret1', default_fast_cli=False, default_global_delay_factor=1, directory=None, mode='RENDER', template_filename=None, compact=False, archive=False, **kwargs):
+		self.id = kwargs.get('id', 'session')
+		self.maxThreads = int(kwargs.get('maxThreads', 3))
 		self.directory = directory
+		self.compact = compact
+		self.archive = archive
 		self.mode = mode
 		self.devices = []
-		#Perform Data Validation
-		host_list = []
-		id_list = []
+		self.executor = None
+		#Compile Templates
+		if template_filename:
+			compiled = TEMPLATE_ENVIRONMENT.get_template(template_filename)
+		else:
+			compiled = TEMPLATE_ENVIRONMENT.from_string(template)
+		#Track Unique Identifiers
+		host_set = set()
+		id_set = set()
+		renders = []
+		required = frozenset(self.datum_schema)
+		#Validate and Load Device Objects in a Single Pass
 		for datum in data:
 			if 'id' in datum:
-				if datum['id'] not in id_list:
-					id_list.append(datum['id'])
-				else:
+				if datum['id'] in id_set:
 					raise SessionError('Atleast two devices have the same id variable. This is not allowed.')
+				id_set.add(datum['id'])
 			if 'host' in datum:
-				if datum['host'] not in host_list:
-					host_list.append(datum['host'])
-				else:
+				if datum['host'] in host_set:
 					raise SessionError('Atleast two devices have the same host variable. This is not allowed.')
-			if 'password' not in datum:
-				datum['password'] = default_password
-			if 'username' not in datum:
-				datum['username'] = default_username
-			if 'secret' not in datum:
-				datum['secret'] = default_secret
-		#Load Device Objects
-		for datum in data:
-			device_template = template
-			if all(prop in list(datum.keys()) for prop in self.datum_schema):
-				#Username if not defined or empty, then set to default_username
-				try:
-					if datum['username'] == '':
-						datum['username'] = default_username
-				except KeyError:
+				host_set.add(datum['host'])
+			device_template = compiled
+			device_template_filename = template_filename
+			if required <= datum.keys():
+				#Credentials if not defined or empty, then set to the session defaults
+				if not datum.get('username'):
 					datum['username'] = default_username
-				#Password if not defined or empty, then set to default_password
-				try:
-					if datum['password'] == '':
-						datum['password'] = default_password
-				except KeyError:
+				if not datum.get('password'):
 					datum['password'] = default_password
-				#Secret if not defined or empty, then set to default_secret
-				try:
-					if datum['secret'] == '':
-						datum['secret'] = default_secret
-				except:
+				if not datum.get('secret'):
 					datum['secret'] = default_secret
+				#Netmiko timing if not defined or empty, then set to the session defaults
+				if datum.get('fast_cli', '') == '':
+					datum['fast_cli'] = default_fast_cli
+				if datum.get('global_delay_factor', '') == '':
+					datum['global_delay_factor'] = default_global_delay_factor
+				try:
+					datum['global_delay_factor'] = float(datum['global_delay_factor'])
+				except (TypeError, ValueError):
+					raise SessionError('global_delay_factor for {} must be a number'.format(datum['host']))
+				#Intern columns that repeat across the inventory so devices share one string object
+				for column in self.internedColumns:
+					if isinstance(datum.get(column), str):
+						datum[column] = sys.intern(datum[column])
+				override_filename = datum.get('template_filename')
+				if override_filename:
+					if os.path.exists(override_filename):
+						device_template = TEMPLATE_ENVIRONMENT.get_template(override_filename)
+						device_template_filename = override_filename
+					else:
+						raise SessionError('Template filename does not exist for {}'.format(datum['host']))
 				try:
-					if 'template_filename' in datum:
-						if datum['template_filename'] != '':
-							if os.path.exists(datum['template_filename']):
-								with open(datum['template_filename'], 'r') as f:
-									device_template = f.read()
-							else:
-								raise SessionError('Template filename does not exist for {}'.format(datum['host']))
-				except TypeError:
-					pass
-				device = Device(**datum)
-				tpl = Environment(loader=BaseLoader).from_string(device_template)
-				device.assign(tpl.render(datum))
+					device = Device(**datum)
+				except ValueError as error:
+					raise SessionError('Invalid connection value for {0}: {1}'.format(datum['host'], error))
+				renders.append((device, device_template, device_template_filename))
 				self.devices.append(device)
 			else:
 				raise SessionError('Atleast one device does not meet the Dynconf data schema')
+		#Render Mode streams each device template to disk in saveInput rather than holding every input in memory
+		if mode == 'RENDER':
+			for device, compiled, filename in renders:
+				device.template = compiled
+			return
+		#Render Device Inputs, spread across processes for large inventories
+		if len(renders) >= self.processRenderThreshold:
+			with ProcessPoolExecutor(initializer=init_render_worker, initargs=(None if template_filename else template,)) as executor:
+				inputs = list(executor.map(render_template, [(filename, device.vars) for device, compiled, filename in renders], chunksize=64))
+		else:
+			inputs = [compiled.render(device.vars) for device, compiled, filename in renders]
+		for (device, compiled, filename), rendered in zip(renders, inputs):
+			device.assign(rendered)
 
 	@classmethod
 	def initFromFiles(cls, data_filename, template_filename, *args, **kwargs):
-		data = []
-		template = ""
-		with open(data_filename, 'r') as f:
-			reader = csv.DictReader(f)
-			for row in reader:
-				data.append(row)
-		with open(template_filename, 'r') as f:
-			template = f.read()
-		return cls(data, template, *args, **kwargs)
+		#Anything other than a known suffix is read as CSV, as it always was
+		reader = DATA_READERS.get(os.path.splitext(data_filename)[1].lower(), read_csv_rows)
+		return cls(reader(data_filename), None, *args, template_filename=template_filename, **kwargs)
 
 	def administer(self, devices=None, ignore_ids=[]):
 		if not devices:
 			devices = self.devices
-		#Create Threads
+		ignore_ids = set(ignore_ids)
+		#Submit Devices to the Thread Pool, shared across administer calls
 		if self.mode != 'RENDER':
-			threads = []
-			length = math.ceil(len(devices)/self.maxThreads)
-			batch = []
-			for device in devices:
-				if device.id not in ignore_ids:
-					batch.append(device)
-				if len(batch) >= length:
-					threads.append(threading.Thread(target=Session.__administerBatch, args=(self, batch)))
-					batch = []
-			if len(batch) > 0:
-				threads.append(threading.Thread(target=Session.__administerBatch, args=(self, batch)))
-			#Start Threads
+			if not self.executor:
+				self.executor = ThreadPoolExecutor(max_workers=self.maxThreads, thread_name_prefix='dynconf')
+			futures = {self.executor.submit(device.connect, self.mode, self.directory): device for device in devices if device.id not in ignore_ids}
 			try:
-				for thread in threads:
-					thread.start()
-				for thread in threads:
-					thread.join()
+				wait(futures)
 			except KeyboardInterrupt:
-				print("Waiting for Active Threads to Finish...")
+				CONSOLE.write("Waiting for Active Threads to Finish...")
+				for future in futures:
+					future.cancel()
+				wait(futures)
+			#Surface unexpected worker exceptions; connect() has already recorded them on the device
+			for future, device in futures.items():
+				error = None if future.cancelled() else future.exception()
+				if error is not None:
+					CONSOLE.write('{0} @ {1} - Unhandled Exception\n{2}'.format(device.id, device.connectionData['host'], ''.join(traceback.format_exception(type(error), error, error.__traceback__)).rstrip()))
 		else:
 			raise SessionError('A Render Mode Session Can Not Administer')
 
-	def render(self):
-		for device in self.devices:
-			device.saveInput(self.directory)
+	def close(self):
+		if self.executor:
+			self.executor.shutdown(wait=True)
+			self.executor = None
 
-	def __administerBatch(self, batch):
-		for device in batch:
-			device.connect(self.mode, self.directory)
+	def __enter__(self):
+		return self
 
-	def recure(self):
-		self.active = True
-		def loop(self):
-			r_cnt = 0
-			ignore=[]
-			v = len(self.devices)
-			while (len(ignore) < v) and self.active:
-				print('RECURSION {0} [{1}/{2}]'.format(r_cnt, v-len(ignore), v))
-				r_cnt+=1
-				self.administer(ignore_ids=ignore)
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __iter__(self):
+		return iter(self.devices)
+
+	def __len__(self):
+		return len(self.devices)
+
+	def render(self):
+		#A single tar archive saves one file creation per device on large inventories
+		if self.archive:
+			with tarfile.open('{0}/{1}.tar'.format(self.directory, self.id), 'w') as tar:
 				for device in self.devices:
-					if (device.log['flag'] == 'PASS') and device.id not in ignore:
-						ignore.append(device.id)
-		t = threading.Thread(target=loop, args=(self,))
+					device.archiveInput(tar)
+			return
+		#File writes release the GIL, so overlap them across a short lived pool
+		with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4), thread_name_prefix='dynconf-render') as executor:
+			list(executor.map(lambda device: device.saveInput(self.directory), self.devices))
+
+	def recure(self):
+		self.stopped = threading.Event()
+		def listen(self):
+			#Poll the console so the listener notices a finished run and can be joined
+			while not self.stopped.is_set():
+				try:
+					if not console_ready(0.2):
+						continue
+					i = input().lower()
+				except (EOFError, OSError, ValueError):
+					break
+				if i.strip() == 'stop':
+					self.stopped.set()
+		CONSOLE.write("Enter 'stop' to end recursion.")
+		t = threading.Thread(target=listen, args=(self,), name='dynconf-listen')
 		t.start()
-		while self.active:
-			i = input('> ').lower()
-			if i == 'stop':
-				self.active = False
+		r_cnt = 0
+		#Only devices yet to pass are carried into the next recursion
+		pending = list(self.devices)
+		v = len(pending)
+		try:
+			while pending and not self.stopped.is_set():
+				CONSOLE.write('RECURSION {0} [{1}/{2}]'.format(r_cnt, len(pending), v))
+				r_cnt+=1
+				self.administer(pending)
+				pending = [device for device in pending if device.flag != 'PASS' and not device.description.startswith('SEND_INTERRUPTED')]
+				self.stopped.wait(0.1)
+		finally:
+			self.stopped.set()
+			t.join()
 
 	def writeSessionLog(self):
-		with open('{0}/{1}.log'.format(self.directory, self.id), 'w') as f:
+		with open('{0}/{1}.log'.format(self.directory, self.id), 'w', buffering=1 << 20) as f:
 			for device in self.devices:
-				f.write('\n'.join(device.formatLog()))
+				device.dumpLog(f)
 
 	def saveSessionLog(self):
-		with open('{0}/{1}.json'.format(self.directory, self.id), 'w') as f:
-			sessionLog = []
-			for device in self.devices:
-				sessionLog.append(device.log)
-			json.dump(sessionLog, f, indent=2)
-	
+		sessionLog = [device.log for device in self.devices]
+		if orjson:
+			with open('{0}/{1}.json'.format(self.directory, self.id), 'wb') as f:
+				f.write(orjson.dumps(sessionLog) if self.compact else orjson.dumps(sessionLog, option=orjson.OPT_INDENT_2))
+		else:
+			with open('{0}/{1}.json'.format(self.directory, self.id), 'w') as f:
+				json.dump(sessionLog, f, indent=None if self.compact else 2, separators=(',', ':') if self.compact else None)
+
 	def writeSessionSummary(self):
 		with open('{0}/{1}.summary.log'.format(self.directory, self.id), 'w') as f:
-			f.write('\nDevices Listed:\n')
-			row = ['HOST_ID', 'IP_ADDRESS', 'DEVICE_FLAG', 'DEVICE_DESCRIPTION']
-			f.write(''.join(col.ljust(16) for col in row))
-			f.write('\n')
-			for device in self.devices:
-				data = device.log
-				row = [data['id'], data['host'], data['flag'], data['description']]
-				f.write(''.join(col.ljust(16) for col in row))
-				f.write('\n')
-				
+			f.write('\nDevices Listed:\n' + SUMMARY_ROW.format('HOST_ID', 'IP_ADDRESS', 'DEVICE_FLAG', 'DEVICE_DESCRIPTION'))
+			f.writelines(SUMMARY_ROW.format(device.id, device.connectionData['host'], device.flag, device.description) for device in self.devices)
 
 class Device:
-	def __init__(self, host, device_type, username, password, port='22', secret='', **kwargs):
-		self.id = host
-		if 'id' in kwargs.keys():
-			self.id = kwargs['id']
-		if 'input' in kwargs.keys():
-			self.assign(kwargs['input'])
-		if ('telnet' in device_type) and (port=='22'):
-			port = '23'
-		self.connectionData = {'host': host, 'device_type': device_type, 'username': username, 'password': password, 'port': port, 'secret': secret}
-		self.log = {'id': self.id, 'host':host, 'username':username, 'password':password, 'port':port, 'flag': 'INIT', 'description': 'INITIALIZED'}
+	__slots__ = ('vars', 'id', 'rendered', 'renderedLines', 'connectionData', 'flag', 'description', 'output', 'attempts', 'template')
+	protocolFailover = {
+		'cisco_ios_telnet': ('cisco_ios', 22, 'Telnet', 'SSH'),
+		'cisco_ios': ('cisco_ios_telnet', 23, 'SSH', 'Telnet'),
+	}
+	commandRetries = 5
+	maxAttempts = 4
+	def __init__(self, host, device_type, username, password, port=22, secret='', fast_cli=False, global_delay_factor=1, **kwargs):
+		#Netmiko timing stays out of the render context; it only shapes connectionData
+		self.vars = dict(kwargs, host=host, device_type=device_type, username=username, password=password, port=port, secret=secret)
+		self.id = kwargs.get('id', host)
+		self.template = None
+		self.assign(kwargs.get('input'))
+		#Normalise the port once here rather than on every ConnectHandler call
+		port = int(port) if port not in ('', None) else 22
+		if ('telnet' in device_type) and (port==22):
+			port = 23
+		if isinstance(fast_cli, str):
+			fast_cli = fast_cli.strip().lower() not in ('false', 'no', '0')
+		#Netmiko's own timing is the default; fast_cli with a global_delay_factor under 1 also shortens the read ceiling of slow commands
+		self.connectionData = {'host': host, 'device_type': device_type, 'username': username, 'password': password, 'port': port, 'secret': secret, 'fast_cli': fast_cli, 'global_delay_factor': float(global_delay_factor)}
+		self.flag, self.description = 'INIT', 'INITIALIZED'
+		self.output = None
 		self.attempts = 0
 
+	@property
+	def log(self):
+		log = {'id': self.id, 'host': self.connectionData['host'], 'port': self.connectionData['port'], 'flag': self.flag, 'description': self.description}
+		if self.output is not None:
+			log['output'] = self.output
+		return log
+
+	@property
+	def input(self):
+		#Render Mode sessions defer rendering; render here on first access for callers that need the text
+		if self.rendered is None and self.template is not None:
+			self.assign(self.template.render(self.vars))
+		return self.rendered
+
+	@property
+	def inputLines(self):
+		return self.renderedLines if self.input else []
+
 	def assign(self, input):
-		self.input = input
+		self.rendered = input
+		self.renderedLines = [line for line in input.splitlines() if line.strip()] if input else []
 
-	def connect(self, mode='CONFIGURE', directory=None, super_log=[]):
-		self.attempts += 1
-		if self.input:
-			try:
-				device = ConnectHandler(**self.connectionData)
-			except ssh_exception.NetMikoAuthenticationException:
-				self.log['flag'], self.log['description'] = 'ERROR', 'BAD_AUTH'
-			except ssh_exception.NetMikoTimeoutException:
-				self.log['flag'], self.log['description'] = 'ERROR', 'TIMEOUT'
-			except ValueError:
-				self.log['flag'], self.log['description'] = 'ERROR', 'VALUE'
-			except ConnectionRefusedError:
-				self.log['flag'], self.log['description'] = 'ERROR', 'REFUSED'
-			except paramiko.ssh_exception.SSHException:
-				self.log['flag'], self.log['description'] = 'ERROR', 'SSH'
-			else:
-				if device:
-					try:
-						if mode == 'CONFIGURE':
-							self.log['output'] = [{'in':self.input , 'out': device.send_config_set(self.input)}]
-						elif mode == 'SHOW':
-							device.enable()
-							t_outs = []
-							cmds = self.input.splitlines()
-							for cmd in cmds:
-								while True:
-									try:
-										t_out = {'in':cmd, 'out':device.send_command_expect(cmd)}
-									except IOError:
-										print('{0} - Trying Again - \"{1}\"'.format(self.id, cmd))
-									else:
-										break
-								t_outs.append(t_out)
-							self.log['output'] = t_outs
-						self.log['flag'], self.log['description'] = 'PASS', 'ADMINISTERED'
-					except ValueError:
-						self.log['flag'], self.log['description'] = 'ERROR', 'MANUAL_REQUIRED'
-					finally:
-						device.disconnect()
-			finally:
-				print('{2} @ {3} - {0}:{1}'.format(self.log['flag'], self.log['description'], self.id, self.connectionData['host']))
-				# Basically, in the event that we failed and it WASNT a timeout, then we want to try connecting again via another protocol
-				if self.log['flag'] == 'ERROR':
-					if self.log['description'] != 'SEND_FAILED':
-						if self.log['description'] != 'TIMEOUT' and self.attempts < 2:
-							old_description = self.log['description']
-							if self.connectionData['device_type'] == 'cisco_ios_telnet':
-								self.connectionData['device_type'] = 'cisco_ios'
-								self.connectionData['port'] = '22'
-								print('\t{} -> Error Occurred on Telnet. Trying SSH.'.format(self.id))
-								self.log = self.connect(mode=mode, directory=directory, super_log=super_log)
-								self.log['description'] += '&'+old_description
-							elif self.connectionData['device_type'] == 'cisco_ios':
-								self.connectionData['device_type'] = 'cisco_ios_telnet'
-								self.connectionData['port'] = '23'
-								print('\t{} -> Error Occurred on SSH. Trying Telnet.'.format(self.id))
-								self.log = self.connect(mode=mode, directory=directory, super_log=super_log)
-								self.log['description'] += '&'+old_description
-					else:
-						#In the event that connection timed out during send, we want to try again and again till we pass
-						print('\t{} -> Send Failed. Trying Again.'.format(self.id))
-						self.log = self.connect(mode=mode, directory=directory, super_log=super_log)
-				if directory:
-					self.writeLog(directory)
-			super_log.append(self.log)
-		else:
+	def connect(self, mode='CONFIGURE', directory=None):
+		if not self.input:
 			raise DeviceError('Device attempted connetion before any input assignment.')
+		failures = []
+		try:
+			for attempt in range(self.maxAttempts):
+				self.attempts += 1
+				try:
+					self.__attempt(mode)
+				except Exception:
+					#Record unexpected failures before the status line and device log are written
+					self.flag, self.description = 'ERROR', 'EXCEPTION'
+					raise
+				finally:
+					CONSOLE.write('{2} @ {3} - {0}:{1}'.format(self.flag, self.description, self.id, self.connectionData['host']))
+				if self.flag != 'ERROR':
+					break
+				if self.description == 'SEND_FAILED':
+					#In the event that connection timed out during send, we want to try again till we pass or run out of attempts
+					if attempt + 1 < self.maxAttempts:
+						CONSOLE.write('\t{} -> Send Failed. Trying Again.'.format(self.id))
+					continue
+				# Basically, in the event that we failed and it WASNT a timeout, then we want to try connecting again via another protocol
+				failover = self.protocolFailover.get(self.connectionData['device_type'])
+				if self.description in ('TIMEOUT', 'SEND_INTERRUPTED') or self.attempts >= 2 or not failover:
+					break
+				device_type, port, protocol, fallback = failover
+				failures.append(self.description)
+				CONNECTION_POOL.discard(self.connectionData)
+				self.connectionData['device_type'], self.connectionData['port'] = device_type, port
+				CONSOLE.write('\t{0} -> Error Occurred on {1}. Trying {2}.'.format(self.id, protocol, fallback))
+			for failure in reversed(failures):
+				self.description += '&'+failure
+		finally:
+			if directory:
+				self.writeLog(directory)
 		return self.log
 
+	def __attempt(self, mode):
+		try:
+			device = CONNECTION_POOL.acquire(self.connectionData)
+		except ssh_exception.NetMikoAuthenticationException:
+			self.flag, self.description = 'ERROR', 'BAD_AUTH'
+		except ssh_exception.NetMikoTimeoutException:
+			self.flag, self.description = 'ERROR', 'TIMEOUT'
+		except ValueError:
+			self.flag, self.description = 'ERROR', 'VALUE'
+		except ConnectionRefusedError:
+			self.flag, self.description = 'ERROR', 'REFUSED'
+		except paramiko.ssh_exception.SSHException:
+			self.flag, self.description = 'ERROR', 'SSH'
+		else:
+			if device:
+				try:
+					if mode == 'CONFIGURE':
+						self.output = [{'in':self.input , 'out': device.send_config_set(self.inputLines)}]
+					elif mode == 'SHOW':
+						device.enable()
+						#Resolve the prompt once rather than per command
+						prompt = re.escape(device.find_prompt())
+						t_outs = []
+						for cmd in self.inputLines:
+							retries = 0
+							while True:
+								try:
+									t_out = {'in':cmd, 'out':device.send_command_expect(cmd, expect_string=prompt)}
+								except IOError as error:
+									retries += 1
+									if retries > self.commandRetries:
+										raise SendFailedError('{0} - Retries exhausted on "{1}"'.format(self.id, cmd)) from error
+									CONSOLE.write('{0} - Trying Again - \"{1}\"'.format(self.id, cmd))
+									#Back off exponentially so a congested link is not hammered
+									time.sleep(min(0.05 * 2 ** retries, 5.0))
+								else:
+									break
+							t_outs.append(t_out)
+						self.output = t_outs
+					self.flag, self.description = 'PASS', 'ADMINISTERED'
+				except ValueError:
+					self.flag, self.description = 'ERROR', 'MANUAL_REQUIRED'
+					#The session itself is still healthy, so pool it for the next recure() pass
+					CONNECTION_POOL.release(self.connectionData, device)
+				except SendFailedError:
+					self.flag, self.description = 'ERROR', 'SEND_FAILED'
+					device.disconnect()
+				except IOError:
+					if mode == 'CONFIGURE':
+						#A partially sent config set must not be pushed again; recure() leaves these devices for manual review
+						self.flag, self.description = 'ERROR', 'SEND_INTERRUPTED'
+					else:
+						#Nothing is half applied in SHOW mode, so the whole command list can safely be sent again
+						self.flag, self.description = 'ERROR', 'SEND_FAILED'
+					device.disconnect()
+				except BaseException:
+					device.disconnect()
+					raise
+				else:
+					#A passed device is never administered again, so close its session now
+					device.disconnect()
+
+	def iterLog(self):
+		yield line_break('#', self.id)
+		yield line_break('@', '{0}: {1}'.format(self.flag, self.description))
+		if self.output is not None:
+			for output in self.output:
+				yield line_break('=', output['in'])
+				#Command output is yielded whole; its own newlines survive the join
+				yield output['out']
+
 	def formatLog(self):
-		lines = []
-		def line_break(line_char, info):
-			ch_len = 86 - len(info)
-			br_str = '\n{0} {1} {0}\n'.format(line_char*(int(ch_len/2)), info.upper())
-			return br_str
-		lines.append(line_break('#', self.log['id']))
-		lines.append(line_break('@', '{0}: {1}'.format(self.log['flag'], self.log['description'])))
-		if 'output' in self.log:
-			for output in self.log['output']:
-				lines.append(line_break('=', output['in']))
-				lines += output['out'].split('\n')
-		return lines
+		return list(self.iterLog())
+
+	def dumpLog(self, f):
+		lines = self.iterLog()
+		f.write(next(lines))
+		f.writelines('\n' + line for line in lines)
 
 	def saveInput(self, directory):
-		if self.input:
+		if self.template is not None and self.rendered is None:
+			with open('{0}/{1}.conf'.format(directory, self.id), 'w') as f:
+				self.template.stream(self.vars).dump(f)
+		elif self.input:
 			with open('{0}/{1}.conf'.format(directory, self.id), 'w') as f:
 				f.write(self.input)
 		else:
 			raise DeviceError('Device can not save input. No Input assigned.')
 
+	def archiveInput(self, tar):
+		input = self.input
+		if not input:
+			raise DeviceError('Device can not save input. No Input assigned.')
+		data = input.encode('utf-8')
+		info = tarfile.TarInfo('{0}.conf'.format(self.id))
+		info.size, info.mtime = len(data), time.time()
+		tar.addfile(info, io.BytesIO(data))
+
 	def writeLog(self, directory):
 		with open('{0}/{1}.log'.format(directory, self.id), 'w') as f:
-			f.write('\n'.join(self.formatLog()))
+			self.dumpLog(f)
 
 class DynconfError(Exception):
 	pass
@@ -344,9 +707,16 @@ class DeviceError(DynconfError):
 class SessionError(DynconfError):
 	pass
 
-def main(*args, **kwargs):
-	print("### DYNCONF V{0} ###\n".format(VERSION))
-	print("©2018 Dyntek Services Inc.\nKenneth J. Grace\nEmail: kenneth.grace@dyntek.com\n")
+class SendFailedError(DeviceError):
+	pass
+
+def build_option_parser():
+
+	"""
+	Builds the command line parser for main.
+	Objective: construct the parser once at import rather than on every call to main.
+	"""
+
 	optparser = OptionParser(usage="usage: %prog [options]")
 	optparser.add_option('-u', '--username', dest='default_username', default='admin',
 						 help='Default username for device connections')
@@ -354,6 +724,10 @@ def main(*args, **kwargs):
 						 help='Default password for device connections')
 	optparser.add_option('-s', '--secret', dest='default_secret', default='Secret1',
 						 help='Default secret for device connections')
+	optparser.add_option('--fast-cli', action='store_true', dest='default_fast_cli', default=False,
+						 help='Enable Netmiko fast_cli for device connections')
+	optparser.add_option('--delay-factor', dest='default_global_delay_factor', default=1.0, type='float',
+						 help='Default Netmiko global_delay_factor for device connections')
 	optparser.add_option('-t', '--template', dest='template_filename',
 						 help='Read template from a jinja2 or Txt file')
 	optparser.add_option('-d', '--data', dest='data_filename',
@@ -366,7 +740,18 @@ def main(*args, **kwargs):
 						 help='assign max number of simultaneous threads')
 	optparser.add_option('--output', dest='directory',
 						 help='Set the output directory for program output')
-	(options, args) = optparser.parse_args()
+	optparser.add_option('--archive', action='store_true', dest='archive', default=False,
+						 help='Write rendered configs to a single tar archive instead of one file per device')
+	optparser.add_option('--compact', action='store_true', dest='compact', default=False,
+						 help='Write the session json log without indentation')
+	return optparser
+
+OPTION_PARSER = build_option_parser()
+
+def main(*args, **kwargs):
+	print("### DYNCONF V{0} ###\n".format(VERSION))
+	print("©2018 Dyntek Services Inc.\nKenneth J. Grace\nEmail: kenneth.grace@dyntek.com\n")
+	(options, args) = OPTION_PARSER.parse_args()
 	while (not options.data_filename) or (not os.path.exists(options.data_filename)):
 		options.data_filename = input('Data Filename [*.json, *.csv]: ')
 	while (not options.template_filename) or (not os.path.exists(options.template_filename)):
@@ -376,30 +761,24 @@ def main(*args, **kwargs):
 	while (not options.mode) or (options.mode not in ['CONFIGURE','SHOW','RENDER']):
 		options.mode = input('Mode [CONFIGURE, SHOW, RENDER]: ').upper()
 	if not options.directory:
+		options.directory = str(Path(options.data_filename).with_suffix('.render' if options.mode == 'RENDER' else '.output'))
+	Path(options.directory).mkdir(parents=True, exist_ok=True)
+	with Session.initFromFiles(**vars(options)) as session:
 		if options.mode != 'RENDER':
-			options.directory = '{}.output'.format(options.data_filename[0:options.data_filename[1:].find('.')+1])
-		else:
-			options.directory = '{}.render'.format(options.data_filename[0:options.data_filename[1:].find('.')+1])
-	try:
-		if not os.path.exists(options.directory):
-			os.makedirs(options.directory)
-	except FileExistsError:
-		pass
-	session = Session.initFromFiles(**vars(options))
-	session.maxThreads = int(options.maxThreads)
-	if options.mode != 'RENDER':
-		if not options.recure:
-			session.administer()
+			if not options.recure:
+				session.administer()
+			else:
+				session.recure()
 		else:
-			session.recure()
-	else:
-		session.render()
-	session.writeSessionLog()
-	session.writeSessionSummary()
-	try:
-		session.saveSessionLog()
-	except SessionError:
-		pass
+			session.render()
+		CONNECTION_POOL.close()
+		session.writeSessionLog()
+		session.writeSessionSummary()
+		try:
+			session.saveSessionLog()
+		except SessionError:
+			pass
 
 if __name__ == '__main__':
+	multiprocessing.freeze_support()
 	main()
\ No newline at end of file